@@ -1,10 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import os
 import json
 import math
+import asyncio
+import threading
+import time
+import random
+import hmac
+import heapq
+import cProfile
+import tracemalloc
+import contextvars
+import logging
+from collections import OrderedDict
 import numpy as np
 from datetime import datetime
 import uuid
@@ -31,6 +43,24 @@ client = MongoClient(MONGO_URL)
 db = client.calculator_db
 history_collection = db.calculation_history
 
+# History cache sizing (entries kept per session, sessions kept in memory)
+HISTORY_CACHE_SIZE = int(os.environ.get('HISTORY_CACHE_SIZE', 50))
+HISTORY_CACHE_SESSIONS = int(os.environ.get('HISTORY_CACHE_SESSIONS', 1000))
+
+# Request profiling (off unless an admin token is configured to read the reports back)
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MAX_REPORTS = int(os.environ.get('PROFILE_MAX_REPORTS', 20))
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', 25))
+PROFILING_ENABLED = bool(PROFILE_ADMIN_TOKEN)
+
+logger = logging.getLogger(__name__)
+
+if PROFILE_SAMPLE_RATE > 0 and not PROFILING_ENABLED:
+    logger.warning(
+        "PROFILE_SAMPLE_RATE is set without PROFILE_ADMIN_TOKEN; request profiling stays disabled"
+    )
+
 # Pydantic models
 class CalculationRequest(BaseModel):
     expression: str
@@ -57,6 +87,341 @@ class FinancialCalculationRequest(BaseModel):
     calculation_type: str  # compound_interest, loan_payment, present_value, etc.
     parameters: Dict[str, float]
 
+# Request coalescing
+class SingleFlight:
+    """Run concurrent identical calls once and share the result with every caller"""
+
+    def __init__(self):
+        self._in_flight: Dict[Any, asyncio.Future] = {}
+        self.calls = 0
+        self.executions = 0
+
+    async def do(self, key, func, *args):
+        """Run func(*args) in the threadpool, joining an in-flight call for the same key"""
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(run_in_threadpool(func, *args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._release(key, done))
+        # Shield so a disconnecting caller does not cancel the work for everyone else
+        return await asyncio.shield(task)
+
+    def forget(self, match) -> None:
+        """Stop handing out in-flight results whose key satisfies match(key)"""
+        for key in [key for key in self._in_flight if match(key)]:
+            del self._in_flight[key]
+
+    def _release(self, key, task: asyncio.Future) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller went away
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        shared = self.calls - self.executions
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "shared": shared,
+            "in_flight": len(self._in_flight),
+            "saved_ratio": shared / self.calls if self.calls else 0.0
+        }
+
+calculation_flight = SingleFlight()
+history_flight = SingleFlight()
+
+# Recent history cache
+class HistoryCache:
+    """Keep the most recent history entries of recently used sessions in memory"""
+
+    def __init__(self, size: int, max_sessions: int):
+        self.size = size
+        self.max_sessions = max_sessions
+        # session_id -> newest-first entries, holding the top `size` entries of the session
+        self._sessions: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        # session_id -> token of the load that may fill the session, dropped on every write
+        self._loads: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Return up to limit cached entries, or None when the database must be queried"""
+        with self._lock:
+            entries = self._sessions.get(session_id)
+            # A full buffer may be hiding older entries, so only shallower pages are served
+            if entries is None or limit <= 0 or (limit > len(entries) and len(entries) >= self.size):
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            return entries[:limit]
+
+    def begin_load(self, session_id: str) -> object:
+        """Register a database load for a session before it is queried"""
+        token = object()
+        with self._lock:
+            self._loads[session_id] = token
+        return token
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and self.max_sessions > 0
+
+    def fill(self, session_id: str, token: object, entries: List[Dict[str, Any]]) -> None:
+        """Cache loaded entries unless the session was written to during the load"""
+        with self._lock:
+            if self._loads.get(session_id) is not token:
+                return
+            del self._loads[session_id]
+            if not self.enabled:
+                return
+            self._sessions[session_id] = entries[:self.size]
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def end_load(self, session_id: str, token: object) -> None:
+        """Drop a finished load's token, whether or not it reached fill"""
+        with self._lock:
+            if self._loads.get(session_id) is token:
+                del self._loads[session_id]
+
+    def begin_write(self, session_id: str) -> None:
+        """Keep loads already running from filling the session, called before writing to MongoDB"""
+        with self._lock:
+            self._loads.pop(session_id, None)
+
+    def insert(self, session_id: str, entry: Dict[str, Any]) -> None:
+        """Add a newly stored entry to the session's buffer if it is cached"""
+        with self._lock:
+            self._loads.pop(session_id, None)
+            entries = self._sessions.get(session_id)
+            if entries is None:
+                return
+            # A load that started after the write may already have picked the entry up
+            if any(cached["calculation_id"] == entry["calculation_id"] for cached in entries):
+                return
+            # Keep newest-first timestamp order even if concurrent requests finish out of order
+            index = 0
+            while index < len(entries) and entries[index]["timestamp"] > entry["timestamp"]:
+                index += 1
+            entries.insert(index, entry)
+            del entries[self.size:]
+
+    def invalidate(self, session_id: str) -> None:
+        """Drop everything cached for a session"""
+        with self._lock:
+            self._loads.pop(session_id, None)
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "sessions": len(self._sessions),
+            "size": self.size,
+            "max_sessions": self.max_sessions
+        }
+
+history_cache = HistoryCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_SESSIONS)
+
+# Request profiling
+PROFILED_PATHS = ("/api/calculate", "/api/financial-calculation", "/api/history/")
+
+_active_profile: contextvars.ContextVar = contextvars.ContextVar("_active_profile", default=None)
+# Only one request is profiled at a time: tracemalloc is process wide
+_profiling_lock = threading.Lock()
+
+def profiled_call(func, *args):
+    """Call func(*args) under the current request's profiler, if there is one"""
+    profile = _active_profile.get()
+    if profile is None:
+        return func(*args)
+    return profile.runcall(func, *args)
+
+async def run_coalesced(flight: SingleFlight, key, func, *args):
+    """Run func(*args) through flight, or alone under the request's profiler when profiling"""
+    profile = _active_profile.get()
+    if profile is None:
+        return await flight.do(key, func, *args)
+    # A profiled request does its own work so its CPU profile is never empty from joining a flight
+    return await run_in_threadpool(profile.runcall, func, *args)
+
+class ProfileStore:
+    """Keep the slowest profiling reports, bounded to max_reports"""
+
+    def __init__(self, max_reports: int):
+        self.max_reports = max_reports
+        self._heap: List[tuple] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add(self, report: Dict[str, Any]) -> None:
+        if self.max_reports <= 0:
+            return
+        with self._lock:
+            self._seq += 1
+            item = (report["duration_ms"], self._seq, report)
+            if len(self._heap) < self.max_reports:
+                heapq.heappush(self._heap, item)
+            else:
+                heapq.heappushpop(self._heap, item)
+
+    def reports(self) -> List[Dict[str, Any]]:
+        """Return stored reports, slowest first"""
+        with self._lock:
+            return [item[2] for item in sorted(self._heap, reverse=True)]
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for _, _, report in self._heap:
+                if report["profile_id"] == profile_id:
+                    return report
+        return None
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._heap)
+            self._heap = []
+            return count
+
+profile_store = ProfileStore(PROFILE_MAX_REPORTS)
+
+def profile_trigger(scope) -> Optional[str]:
+    """Decide whether a request should be profiled and why"""
+    for name, value in scope["headers"]:
+        if name == b"x-profile" and hmac.compare_digest(value, PROFILE_ADMIN_TOKEN.encode()):
+            return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+def build_profile_report(scope, trigger: str, profile: cProfile.Profile, start_snapshot, end_snapshot,
+                         peak_bytes: int, duration_ms: float, status_code: Optional[int]) -> Dict[str, Any]:
+    """Summarise a request's CPU and allocation profiles into a JSON-friendly report"""
+    profile.create_stats()
+    cpu_top = [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "total_time": total_time,
+            "cumulative_time": cumulative_time
+        }
+        for (filename, line, name), (_, calls, total_time, cumulative_time, _) in sorted(
+            profile.stats.items(), key=lambda item: item[1][3], reverse=True
+        )[:PROFILE_TOP_N]
+    ]
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ]
+    # Net change in live memory per line between the start and the end of the request
+    alloc_diff = end_snapshot.filter_traces(filters).compare_to(start_snapshot.filter_traces(filters), "lineno")
+    alloc_top = [
+        {
+            "location": str(stat.traceback),
+            "size_diff_bytes": stat.size_diff,
+            "count_diff": stat.count_diff,
+            "size_bytes": stat.size
+        }
+        for stat in alloc_diff[:PROFILE_TOP_N]
+    ]
+    return {
+        "profile_id": str(uuid.uuid4()),
+        "method": scope["method"],
+        "path": scope["path"],
+        "query_string": scope["query_string"].decode("latin-1"),
+        "trigger": trigger,
+        "status_code": status_code,
+        "timestamp": datetime.now().isoformat(),
+        "duration_ms": duration_ms,
+        "peak_alloc_bytes": peak_bytes,
+        "cpu_top": cpu_top,
+        "alloc_top": alloc_top,
+        # tracemalloc is process wide, so concurrent unprofiled requests are included
+        "alloc_scope": "net live-memory change during the request, process wide; freed temporaries only show in peak_alloc_bytes"
+    }
+
+class ProfilingMiddleware:
+    """Profile sampled or explicitly requested calls to the profiled endpoints"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROFILED_PATHS):
+            return await self.app(scope, receive, send)
+        trigger = profile_trigger(scope)
+        if trigger is None or not _profiling_lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        status_code = None
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started_tracing = False
+        try:
+            profile = cProfile.Profile()
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            start_snapshot = tracemalloc.take_snapshot()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        except Exception:
+            # Profiling must never fail the request itself, so serve it unprofiled
+            logger.exception("Could not start request profiling")
+            try:
+                if started_tracing and tracemalloc.is_tracing():
+                    tracemalloc.stop()
+            finally:
+                _profiling_lock.release()
+            return await self.app(scope, receive, send)
+
+        context_token = _active_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            _active_profile.reset(context_token)
+            self._finish(scope, trigger, profile, started_tracing, start_snapshot, start_bytes,
+                         duration_ms, status_code)
+
+    def _finish(self, scope, trigger: str, profile: cProfile.Profile, started_tracing: bool,
+                start_snapshot, start_bytes: int, duration_ms: float, status_code: Optional[int]) -> None:
+        """Stop tracing, release the profiling lock and store the report without raising"""
+        try:
+            try:
+                # Peak above what was already traced when the request started
+                peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+                end_snapshot = tracemalloc.take_snapshot()
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+            profile_store.add(build_profile_report(
+                scope, trigger, profile, start_snapshot, end_snapshot, peak_bytes, duration_ms, status_code
+            ))
+        except Exception:
+            # Never let a failed report replace the request's own outcome
+            logger.exception("Could not record request profile")
+        finally:
+            _profiling_lock.release()
+
+# Only install the middleware when profiling is configured, so it costs nothing otherwise
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
 # Helper functions for number system conversions
 def convert_number_base(value: str, from_base: str, to_base: str) -> str:
     """Convert number between different bases"""
@@ -159,6 +524,66 @@ def bitwise_operation(a: int, b: int, operation: str) -> int:
     
     return operations[operation](a, b)
 
+# Expression evaluation
+def evaluate_expression(expression: str, mode: str, number_system: str):
+    """Evaluate an expression, returning (result, formatted_result)"""
+    result = None
+    formatted_result = ""
+    
+    if mode == "basic":
+        # Basic arithmetic
+        result = eval(expression.replace("^", "**"))
+        formatted_result = str(result)
+        
+    elif mode == "scientific":
+        # Scientific calculations
+        result = safe_eval_scientific(expression)
+        formatted_result = f"{result:.10g}"
+        
+    elif mode == "programming":
+        # Handle programming mode with different number systems
+        if number_system != "decimal":
+            # Convert expression to decimal, calculate, then convert back
+            # This is a simplified approach - would need more complex parsing for full support
+            result = eval(expression.replace("^", "**"))
+            decimal_result = int(result)
+            if number_system == "hexadecimal":
+                formatted_result = hex(decimal_result)[2:].upper()
+            elif number_system == "octal":
+                formatted_result = oct(decimal_result)[2:]
+            elif number_system == "binary":
+                formatted_result = bin(decimal_result)[2:]
+        else:
+            result = eval(expression.replace("^", "**"))
+            formatted_result = str(result)
+    
+    return result, formatted_result
+
+# History queries
+def query_history(session_id: str, limit: int) -> List[Dict[str, Any]]:
+    """Fetch the most recent history entries for a session from MongoDB"""
+    return list(history_collection.find(
+        {"session_id": session_id},
+        {"_id": 0}
+    ).sort("timestamp", -1).limit(limit))
+
+def load_history(session_id: str, limit: int) -> List[Dict[str, Any]]:
+    """Fetch history from MongoDB, filling the history cache when the page is cacheable"""
+    if limit <= 0 or not history_cache.enabled:
+        return query_history(session_id, limit)
+    token = history_cache.begin_load(session_id)
+    try:
+        # Fetch at least a full buffer so the cache can serve the next shallow reads
+        history = query_history(session_id, max(limit, history_cache.size))
+        history_cache.fill(session_id, token, history)
+    finally:
+        history_cache.end_load(session_id, token)
+    return history[:limit]
+
+def forget_history_reads(session_id: str) -> None:
+    """Make later history reads for a session start a fresh query after a write"""
+    history_flight.forget(lambda key: key[0] == session_id)
+
 # API Routes
 
 @app.get("/api/health")
@@ -170,37 +595,18 @@ async def calculate(request: CalculationRequest):
     """Main calculation endpoint"""
     calculation_id = str(uuid.uuid4())
     timestamp = datetime.now().isoformat()
+    written_session_id = None
     
     try:
-        result = None
-        formatted_result = ""
-        
-        if request.mode == "basic":
-            # Basic arithmetic
-            result = eval(request.expression.replace("^", "**"))
-            formatted_result = str(result)
-            
-        elif request.mode == "scientific":
-            # Scientific calculations
-            result = safe_eval_scientific(request.expression)
-            formatted_result = f"{result:.10g}"
-            
-        elif request.mode == "programming":
-            # Handle programming mode with different number systems
-            if request.number_system != "decimal":
-                # Convert expression to decimal, calculate, then convert back
-                # This is a simplified approach - would need more complex parsing for full support
-                result = eval(request.expression.replace("^", "**"))
-                decimal_result = int(result)
-                if request.number_system == "hexadecimal":
-                    formatted_result = hex(decimal_result)[2:].upper()
-                elif request.number_system == "octal":
-                    formatted_result = oct(decimal_result)[2:]
-                elif request.number_system == "binary":
-                    formatted_result = bin(decimal_result)[2:]
-            else:
-                result = eval(request.expression.replace("^", "**"))
-                formatted_result = str(result)
+        # Identical concurrent expressions are evaluated once and shared
+        result, formatted_result = await run_coalesced(
+            calculation_flight,
+            (request.expression, request.mode, request.number_system),
+            evaluate_expression,
+            request.expression,
+            request.mode,
+            request.number_system
+        )
         
         # Store in database
         calculation_doc = {
@@ -214,7 +620,13 @@ async def calculate(request: CalculationRequest):
             "session_id": request.session_id or "default"
         }
         
-        history_collection.insert_one(calculation_doc)
+        # insert_one adds an _id to the document, so cache a copy without it
+        cached_doc = dict(calculation_doc)
+        written_session_id = cached_doc["session_id"]
+        history_cache.begin_write(written_session_id)
+        profiled_call(history_collection.insert_one, calculation_doc)
+        history_cache.insert(written_session_id, cached_doc)
+        forget_history_reads(written_session_id)
         
         return CalculationResponse(
             result=str(result),
@@ -227,6 +639,10 @@ async def calculate(request: CalculationRequest):
         )
         
     except Exception as e:
+        if written_session_id is not None:
+            # The write may have committed anyway, so the next read must go back to MongoDB
+            history_cache.invalidate(written_session_id)
+            forget_history_reads(written_session_id)
         return CalculationResponse(
             result="Error",
             formatted_result="Error",
@@ -252,20 +668,23 @@ async def financial_calculation(request: FinancialCalculationRequest):
     """Perform financial calculations"""
     try:
         if request.calculation_type == "compound_interest":
-            result = calculate_compound_interest(
+            result = profiled_call(
+                calculate_compound_interest,
                 request.parameters["principal"],
                 request.parameters["rate"],
                 request.parameters["time"],
                 request.parameters.get("n", 1)
             )
         elif request.calculation_type == "loan_payment":
-            result = calculate_loan_payment(
+            result = profiled_call(
+                calculate_loan_payment,
                 request.parameters["principal"],
                 request.parameters["rate"],
                 request.parameters["periods"]
             )
         elif request.calculation_type == "present_value":
-            result = calculate_present_value(
+            result = profiled_call(
+                calculate_present_value,
                 request.parameters["future_value"],
                 request.parameters["rate"],
                 request.parameters["periods"]
@@ -282,10 +701,9 @@ async def financial_calculation(request: FinancialCalculationRequest):
 async def get_calculation_history(session_id: str, limit: int = 50):
     """Get calculation history for a session"""
     try:
-        history = list(history_collection.find(
-            {"session_id": session_id},
-            {"_id": 0}
-        ).sort("timestamp", -1).limit(limit))
+        history = history_cache.get(session_id, limit)
+        if history is None:
+            history = await run_coalesced(history_flight, (session_id, limit), load_history, session_id, limit)
         
         return {"session_id": session_id, "history": history, "count": len(history)}
         
@@ -296,12 +714,58 @@ async def get_calculation_history(session_id: str, limit: int = 50):
 async def clear_calculation_history(session_id: str):
     """Clear calculation history for a session"""
     try:
-        result = history_collection.delete_many({"session_id": session_id})
+        result = profiled_call(history_collection.delete_many, {"session_id": session_id})
+        history_cache.invalidate(session_id)
+        forget_history_reads(session_id)
         return {"session_id": session_id, "deleted_count": result.deleted_count}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/stats/coalescing")
+async def coalescing_stats():
+    """Report how much duplicate work request coalescing has saved"""
+    return {
+        "calculate": calculation_flight.stats(),
+        "history": history_flight.stats()
+    }
+
+@app.get("/api/stats/history-cache")
+async def history_cache_stats():
+    """Report how often history reads are served from memory"""
+    return history_cache.stats()
+
+def require_admin(token: Optional[str]) -> None:
+    """Reject admin calls without the configured profiling admin token"""
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str values
+    if not PROFILE_ADMIN_TOKEN or not token or not hmac.compare_digest(token.encode(), PROFILE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/api/admin/profiles")
+async def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """List stored request profiles, slowest first"""
+    require_admin(x_admin_token)
+    reports = [
+        {key: report[key] for key in ("profile_id", "method", "path", "trigger", "status_code", "timestamp", "duration_ms", "peak_alloc_bytes")}
+        for report in profile_store.reports()
+    ]
+    return {"enabled": PROFILING_ENABLED, "sample_rate": PROFILE_SAMPLE_RATE, "profiles": reports, "count": len(reports)}
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Get the full CPU and allocation report of a stored profile"""
+    require_admin(x_admin_token)
+    report = profile_store.get(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
+
+@app.delete("/api/admin/profiles")
+async def clear_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Discard all stored profiles"""
+    require_admin(x_admin_token)
+    return {"deleted_count": profile_store.clear()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
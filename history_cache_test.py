@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the recent history cache (HistoryCache, load_history) in backend/server.py
+Run with: python -m pytest -q history_cache_test.py
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server
+from server import HistoryCache
+
+
+def entry(n: int, session_id: str = "s") -> dict:
+    return {"calculation_id": f"calc-{n}", "timestamp": f"2024-01-01T00:00:{n:02d}", "session_id": session_id}
+
+
+def filled(cache: HistoryCache, session_id: str, entries):
+    token = cache.begin_load(session_id)
+    cache.fill(session_id, token, entries)
+    cache.end_load(session_id, token)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, limit):
+        return iter(self.docs[:limit] if limit > 0 else self.docs)
+
+
+class FakeCollection:
+    def __init__(self, docs=None, error=None):
+        self.docs = docs or []
+        self.error = error
+        self.queries = []
+
+    def find(self, query, projection):
+        self.queries.append(query)
+        if self.error is not None:
+            raise self.error
+        return FakeCursor([doc for doc in self.docs if doc["session_id"] == query["session_id"]])
+
+    def insert_one(self, doc):
+        if self.error is not None:
+            raise self.error
+        # Like pymongo, insert_one adds an _id to the document it is given
+        doc["_id"] = len(self.docs)
+        self.docs.append(doc)
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """Point load_history at a fresh cache and an in-memory collection"""
+    def install(cache: HistoryCache, collection: FakeCollection):
+        monkeypatch.setattr(server, "history_cache", cache)
+        monkeypatch.setattr(server, "history_collection", collection)
+    return install
+
+
+def test_unloaded_session_misses():
+    cache = HistoryCache(3, 10)
+    assert cache.get("s", 10) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_fill_then_get_serves_newest_first():
+    cache = HistoryCache(3, 10)
+    filled(cache, "s", [entry(3), entry(2), entry(1)])
+
+    assert cache.get("s", 2) == [entry(3), entry(2)]
+    assert cache.stats()["hits"] == 1
+
+
+def test_partial_buffer_answers_deeper_limits():
+    cache = HistoryCache(5, 10)
+    filled(cache, "s", [entry(2), entry(1)])
+
+    # Fewer entries than the buffer size means this is the whole session
+    assert cache.get("s", 50) == [entry(2), entry(1)]
+
+
+def test_full_buffer_sends_deeper_pages_to_database():
+    cache = HistoryCache(3, 10)
+    filled(cache, "s", [entry(3), entry(2), entry(1)])
+
+    assert cache.get("s", 3) == [entry(3), entry(2), entry(1)]
+    assert cache.get("s", 4) is None
+
+
+def test_non_positive_limit_bypasses_cache():
+    cache = HistoryCache(3, 10)
+    filled(cache, "s", [entry(1)])
+
+    assert cache.get("s", 0) is None
+    assert cache.get("s", -1) is None
+
+
+def test_insert_keeps_timestamp_order_and_bound():
+    cache = HistoryCache(3, 10)
+    filled(cache, "s", [entry(5), entry(3)])
+
+    cache.insert("s", entry(6))
+    # A request that started earlier but finished later lands in timestamp order
+    cache.insert("s", entry(4))
+
+    assert cache.get("s", 3) == [entry(6), entry(5), entry(4)]
+
+
+def test_insert_older_than_full_buffer_is_dropped():
+    cache = HistoryCache(2, 10)
+    filled(cache, "s", [entry(5), entry(4)])
+
+    cache.insert("s", entry(1))
+
+    assert cache.get("s", 2) == [entry(5), entry(4)]
+
+
+def test_insert_into_unloaded_session_is_ignored():
+    cache = HistoryCache(3, 10)
+    cache.insert("s", entry(1))
+
+    assert cache.get("s", 1) is None
+
+
+def test_insert_skips_entry_already_loaded():
+    cache = HistoryCache(3, 10)
+    cache.begin_write("s")
+    # A load that started after the write committed already picked the entry up
+    filled(cache, "s", [entry(1)])
+    cache.insert("s", entry(1))
+
+    assert cache.get("s", 3) == [entry(1)]
+
+
+def test_write_during_load_prevents_fill():
+    cache = HistoryCache(3, 10)
+    token = cache.begin_load("s")
+    cache.begin_write("s")
+    cache.fill("s", token, [entry(1)])
+    cache.end_load("s", token)
+
+    assert cache.get("s", 1) is None
+    assert cache._loads == {}
+
+
+def test_invalidate_drops_session_and_pending_load():
+    cache = HistoryCache(3, 10)
+    filled(cache, "s", [entry(1)])
+    token = cache.begin_load("other")
+
+    cache.invalidate("s")
+    cache.invalidate("other")
+    cache.fill("other", token, [entry(2, "other")])
+
+    assert cache.get("s", 1) is None
+    assert cache.get("other", 1) is None
+
+
+def test_least_recently_used_session_is_evicted():
+    cache = HistoryCache(3, 2)
+    filled(cache, "a", [entry(1, "a")])
+    filled(cache, "b", [entry(2, "b")])
+    cache.get("a", 1)
+    filled(cache, "c", [entry(3, "c")])
+
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == [entry(1, "a")]
+    assert cache.get("c", 1) == [entry(3, "c")]
+    assert cache.stats()["sessions"] == 2
+
+
+def test_disabled_cache_stores_nothing():
+    cache = HistoryCache(0, 10)
+    filled(cache, "s", [entry(1)])
+
+    assert not cache.enabled
+    assert cache.get("s", 1) is None
+    assert cache._loads == {}
+
+
+def test_load_history_fills_cache_for_next_read(fake_backend):
+    cache = HistoryCache(3, 10)
+    collection = FakeCollection([entry(n) for n in range(1, 6)])
+    fake_backend(cache, collection)
+
+    assert server.load_history("s", 2) == [entry(5), entry(4)]
+    # A full buffer is fetched so the next slightly deeper read is served from memory
+    assert cache.get("s", 3) == [entry(5), entry(4), entry(3)]
+    assert len(collection.queries) == 1
+
+
+def test_load_history_leaves_no_tokens_behind(fake_backend):
+    cache = HistoryCache(3, 10)
+    fake_backend(cache, FakeCollection([entry(1)]))
+    for n in range(5):
+        server.load_history(f"unlimited-{n}", 0)
+
+    fake_backend(cache, FakeCollection(error=RuntimeError("mongo down")))
+    for n in range(5):
+        with pytest.raises(RuntimeError):
+            server.load_history(f"failing-{n}", 10)
+
+    assert cache._loads == {}
+
+
+def test_load_history_with_cache_disabled_leaves_no_tokens(fake_backend):
+    cache = HistoryCache(0, 10)
+    fake_backend(cache, FakeCollection([entry(1)]))
+    for n in range(5):
+        assert server.load_history(f"s{n}", 10) == []
+
+    assert cache._loads == {}
+
+
+def test_calculate_inserts_into_cached_session(fake_backend):
+    cache = HistoryCache(3, 10)
+    fake_backend(cache, FakeCollection())
+    filled(cache, "s", [])
+
+    response = asyncio.run(server.calculate(server.CalculationRequest(expression="1+1", session_id="s")))
+
+    assert response.error is None
+    [cached] = cache.get("s", 3)
+    assert cached["calculation_id"] == response.calculation_id
+    assert "_id" not in cached
+
+
+def test_failed_history_write_invalidates_session(fake_backend):
+    cache = HistoryCache(3, 10)
+    # The write may have committed even though the driver reported an error
+    fake_backend(cache, FakeCollection(error=TimeoutError("network timeout")))
+    filled(cache, "s", [entry(1)])
+
+    response = asyncio.run(server.calculate(server.CalculationRequest(expression="1+1", session_id="s")))
+
+    assert response.error == "network timeout"
+    assert cache.get("s", 1) is None
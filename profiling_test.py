@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Unit tests for opt-in request profiling (ProfilingMiddleware, ProfileStore, admin auth) in backend/server.py
+Run with: python -m pytest -q profiling_test.py
+"""
+
+import asyncio
+import os
+import sys
+import tracemalloc
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server
+from server import HTTPException, ProfileStore, ProfilingMiddleware
+
+
+def http_scope(path="/api/calculate", headers=None):
+    return {
+        "type": "http",
+        "method": "POST",
+        "path": path,
+        "query_string": b"",
+        "headers": headers or []
+    }
+
+
+def report(duration_ms: float, profile_id: str) -> dict:
+    return {"profile_id": profile_id, "duration_ms": duration_ms}
+
+
+async def ok_app(scope, receive, send):
+    server.profiled_call(sum, range(1000))
+    await send({"type": "http.response.start", "status": 200})
+
+
+async def failing_app(scope, receive, send):
+    raise RuntimeError("handler failed")
+
+
+def run_request(app, scope):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(ProfilingMiddleware(app)(scope, None, send))
+    return sent
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    """Enable profiling with a known token and a fresh report store"""
+    store = ProfileStore(5)
+    monkeypatch.setattr(server, "PROFILE_ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(server, "PROFILE_SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(server, "profile_store", store)
+    yield store
+    assert not server._profiling_lock.locked()
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong", "secret-but-longer", "é", "sécret"])
+def test_require_admin_rejects_bad_tokens(profiling, token):
+    with pytest.raises(HTTPException) as excinfo:
+        server.require_admin(token)
+    assert excinfo.value.status_code == 403
+
+
+def test_require_admin_accepts_configured_token(profiling):
+    server.require_admin("secret")
+
+
+def test_require_admin_rejects_everything_without_configured_token(profiling, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_ADMIN_TOKEN", "")
+    with pytest.raises(HTTPException) as excinfo:
+        server.require_admin("")
+    assert excinfo.value.status_code == 403
+
+
+def test_trigger_on_matching_header(profiling):
+    assert server.profile_trigger(http_scope(headers=[(b"x-profile", b"secret")])) == "header"
+
+
+@pytest.mark.parametrize("value", [b"wrong", b"", "é".encode("latin-1")])
+def test_no_trigger_on_wrong_header(profiling, value):
+    assert server.profile_trigger(http_scope(headers=[(b"x-profile", value)])) is None
+
+
+def test_trigger_on_sampling(profiling, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_SAMPLE_RATE", 0.5)
+    monkeypatch.setattr(server.random, "random", lambda: 0.25)
+    assert server.profile_trigger(http_scope()) == "sample"
+
+    monkeypatch.setattr(server.random, "random", lambda: 0.75)
+    assert server.profile_trigger(http_scope()) is None
+
+
+def test_store_keeps_slowest_reports_first():
+    store = ProfileStore(2)
+    store.add(report(5.0, "slow"))
+    store.add(report(1.0, "fast"))
+    store.add(report(3.0, "medium"))
+
+    assert [r["profile_id"] for r in store.reports()] == ["slow", "medium"]
+    assert store.get("fast") is None
+    assert store.get("medium")["duration_ms"] == 3.0
+    assert store.clear() == 2
+    assert store.reports() == []
+
+
+def test_store_with_no_capacity_keeps_nothing():
+    store = ProfileStore(0)
+    store.add(report(1.0, "only"))
+    assert store.reports() == []
+
+
+def test_profiled_request_stores_report(profiling):
+    sent = run_request(ok_app, http_scope(headers=[(b"x-profile", b"secret")]))
+
+    assert sent[0]["status"] == 200
+    [stored] = profiling.reports()
+    assert stored["trigger"] == "header"
+    assert stored["status_code"] == 200
+    assert stored["cpu_top"]
+
+
+def test_unprofiled_paths_and_requests_are_passed_through(profiling):
+    run_request(ok_app, http_scope())
+    run_request(ok_app, http_scope(path="/api/health", headers=[(b"x-profile", b"secret")]))
+
+    assert profiling.reports() == []
+
+
+def test_failing_request_releases_lock_and_stops_tracing(profiling):
+    with pytest.raises(RuntimeError, match="handler failed"):
+        run_request(failing_app, http_scope(headers=[(b"x-profile", b"secret")]))
+
+    [stored] = profiling.reports()
+    assert stored["status_code"] is None
+
+
+def test_report_failure_keeps_request_exception(profiling, monkeypatch):
+    def broken_report(*args):
+        raise ValueError("report failed")
+
+    monkeypatch.setattr(server, "build_profile_report", broken_report)
+    with pytest.raises(RuntimeError, match="handler failed"):
+        run_request(failing_app, http_scope(headers=[(b"x-profile", b"secret")]))
+
+    assert profiling.reports() == []
+
+
+def test_setup_failure_serves_request_unprofiled(profiling, monkeypatch):
+    def broken_snapshot():
+        raise MemoryError
+
+    monkeypatch.setattr(server.tracemalloc, "take_snapshot", broken_snapshot)
+    sent = run_request(ok_app, http_scope(headers=[(b"x-profile", b"secret")]))
+
+    assert sent[0]["status"] == 200
+    assert profiling.reports() == []
+
+
+def test_busy_profiler_serves_request_unprofiled(profiling):
+    server._profiling_lock.acquire()
+    try:
+        run_request(ok_app, http_scope(headers=[(b"x-profile", b"secret")]))
+    finally:
+        server._profiling_lock.release()
+
+    assert profiling.reports() == []
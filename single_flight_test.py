@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Unit tests for request coalescing (SingleFlight) in backend/server.py
+Run with: python -m pytest -q single_flight_test.py
+"""
+
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from server import SingleFlight
+
+
+class BlockingWork:
+    """Threadpool work that counts its runs and waits until released"""
+
+    def __init__(self, result="done", error=None):
+        self.result = result
+        self.error = error
+        self.runs = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, *args):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return (self.result,) + args
+
+
+async def wait_started(work: BlockingWork):
+    await asyncio.get_running_loop().run_in_executor(None, work.started.wait, 5)
+
+
+def test_concurrent_identical_keys_run_once():
+    async def scenario():
+        flight = SingleFlight()
+        work = BlockingWork()
+        callers = [asyncio.ensure_future(flight.do("key", work, 1)) for _ in range(10)]
+        await wait_started(work)
+        work.release.set()
+        results = await asyncio.gather(*callers)
+
+        assert results == [("done", 1)] * 10
+        assert work.runs == 1
+        stats = flight.stats()
+        assert stats["calls"] == 10
+        assert stats["executions"] == 1
+        assert stats["shared"] == 9
+        assert stats["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight()
+        work = BlockingWork()
+        work.release.set()
+        results = await asyncio.gather(flight.do("a", work, 1), flight.do("b", work, 2))
+
+        assert results == [("done", 1), ("done", 2)]
+        assert work.runs == 2
+
+    asyncio.run(scenario())
+
+
+def test_forget_forces_a_new_execution():
+    async def scenario():
+        flight = SingleFlight()
+        stale = BlockingWork(result="stale")
+        fresh = BlockingWork(result="fresh")
+        fresh.release.set()
+
+        first = asyncio.ensure_future(flight.do(("session", 50), stale))
+        await wait_started(stale)
+        # A write to the session happens while the first read is still running
+        flight.forget(lambda key: key[0] == "session")
+        second = await flight.do(("session", 50), fresh)
+        stale.release.set()
+
+        assert second == ("fresh",)
+        assert await first == ("stale",)
+        assert flight.stats()["executions"] == 2
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_exception_reaches_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+        work = BlockingWork(error=ValueError("Invalid expression"))
+        callers = [asyncio.ensure_future(flight.do("key", work)) for _ in range(3)]
+        await wait_started(work)
+        work.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        assert work.runs == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_shared_work():
+    async def scenario():
+        flight = SingleFlight()
+        work = BlockingWork()
+        leader = asyncio.ensure_future(flight.do("key", work))
+        follower = asyncio.ensure_future(flight.do("key", work))
+        await wait_started(work)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+
+        assert await follower == ("done",)
+        assert leader.cancelled()
+        assert work.runs == 1
+
+    asyncio.run(scenario())